@@ -134,7 +134,7 @@ class Categorizer:
         if len(file_list) < group_size:
             return False
 
-        seq_finder = re.compile(r"(?<![0-9])(?:0?[1-9]|[1-9][0-9])(?![0-9])").finditer
+        seq_finder = re_compile(r"(?<![0-9])(?:0?[1-9]|[1-9][0-9])(?![0-9])").finditer
         dir_files = defaultdict(list)
         groups = defaultdict(set)
 
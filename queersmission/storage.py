@@ -3,6 +3,7 @@ import os.path as op
 import shutil
 import time
 from functools import cached_property
+from operator import ne
 from typing import Dict, List, Optional, Set
 
 from . import logger
@@ -278,6 +279,14 @@ def knapsack(
     if capacity >= sum(weights):
         return set(range(n))
 
+    # Items of zero weight are always included, and items heavier than the
+    # capacity never fit. Only the rest enter the DP table.
+    res = {i for i in range(n) if weights[i] == 0 and values[i] >= 0}
+    index = [i for i in range(n) if 0 < weights[i] <= capacity]
+    weights = tuple(weights[i] for i in index)
+    values = tuple(values[i] for i in index)
+    n = len(index)
+
     # Scale down
     # We want: (capacity / i + 1) * (n + 1) = max_cells
     if max_cells is not None:
@@ -287,24 +296,29 @@ def knapsack(
             weights = tuple(ceil(w / i) for w in weights)
             capacity = int(capacity // i)  # round up weights, round down capacity
 
-    # Fill dynamic programming table
-    dp = [[0] * (capacity + 1) for _ in range(n + 1)]
-    for i in range(1, n + 1):
-        wt = weights[i - 1]
-        vl = values[i - 1]
-        for w in range(1, capacity + 1):
-            if wt <= w:
-                dp[i][w] = max(dp[i - 1][w], dp[i - 1][w - wt] + vl)
-            else:
-                dp[i][w] = dp[i - 1][w]
+    # Fill dynamic programming table, one whole row per item. Cells below `wt`
+    # are copied from the previous row, the rest are computed in a single list
+    # comprehension: dp[i][w] = max(dp[i-1][w], dp[i-1][w-wt] + vl)
+    # Only the last row is kept. For backtracking, `keep[i][w]` is 1 if item i
+    # improved cell w, stored as one byte per cell instead of a row of ints.
+    dp = [0] * (capacity + 1)
+    keep = []
+    skip = bytes(capacity + 1)
+    for wt, vl in zip(weights, values):
+        if wt > capacity:
+            keep.append(skip)
+            continue
+        row = dp[:wt]
+        row += [a if a >= b else b for a, b in zip(dp[wt:], map(vl.__add__, dp))]
+        keep.append(bytes(map(ne, row, dp)))
+        dp = row
 
     # Backtrack to find which items are included
-    res = set()
     w = capacity
-    for i in range(n, 0, -1):
-        if dp[i][w] != dp[i - 1][w]:
-            res.add(i - 1)
-            w -= weights[i - 1]
+    for i in range(n - 1, -1, -1):
+        if keep[i][w]:
+            res.add(index[i])
+            w -= weights[i]
     return res
 
 
@@ -3,6 +3,7 @@
 import os
 import os.path as op
 import random
+import re
 import sys
 import tempfile
 import unittest
@@ -18,30 +19,60 @@ sys.path.append(str(Path(__file__).resolve().parents[1]))
 from queersmission.storage import knapsack
 from queersmission.utils import copy_file
 
+try:
+    from tools.pattern_builder import trie_to_regex
+except ImportError:  # Regen is not installed
+    trie_to_regex = None
+
+_CONTENT = b"Claire"
+
 
 class TestFileOperations(unittest.TestCase):
 
-    def setUp(self):
-        # Create a temporary directory to isolate file system operations
-        self.root = tempfile.TemporaryDirectory()
-        self.src = op.join(self.root.name, "src")
-        self.dst = op.join(self.root.name, "dst")
-        os.makedirs(self.src, exist_ok=True)
-        os.makedirs(self.dst, exist_ok=True)
+    @classmethod
+    def setUpClass(cls):
+        # Create one temporary directory (in memory if possible) shared by all
+        # tests of the class
+        cls._root = tempfile.TemporaryDirectory(
+            dir="/dev/shm" if op.isdir("/dev/shm") else None
+        )
 
-    def tearDown(self):
-        # Clean up the temporary directory after each test
-        self.root.cleanup()
+    @classmethod
+    def tearDownClass(cls):
+        cls._root.cleanup()
 
-    def assertFileContent(self, file, content):
-        with open(file, "r") as f:
-            self.assertEqual(f.read(), content)
+    def setUp(self):
+        # Isolate each test in its own sub-paths, which are created on demand
+        token = os.urandom(8).hex()
+        self.src = op.join(self._root.name, "src", token)
+        self.dst = op.join(self._root.name, "dst", token)
+
+    def assertTreeEqual(self, root, expected: dict):
+        """Assert that the files under `root` are exactly `expected`, a dict of
+        {relpath: content}."""
+        result = {}
+        stack = [root]
+        while stack:
+            with os.scandir(stack.pop()) as it:
+                for e in it:
+                    if e.is_dir(follow_symlinks=False):
+                        stack.append(e.path)
+                    else:
+                        path = op.relpath(e.path, root).replace(os.sep, "/")
+                        with open(e.path, "rb") as f:
+                            result[path] = f.read()
+        self.assertDictEqual(result, expected)
 
     @staticmethod
-    def _touch(file, content: str = "Claire"):
+    def _touch(file, content=_CONTENT):
+        if isinstance(content, str):
+            content = content.encode()
         os.makedirs(op.dirname(file), exist_ok=True)
-        with open(file, "w") as f:
-            f.write(content)
+        fd = os.open(file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            os.write(fd, content)
+        finally:
+            os.close(fd)
 
     @staticmethod
     def _run_copy(src, dst_dir):
@@ -79,8 +110,8 @@ class TestFileOperations(unittest.TestCase):
         # copy dir
         self._touch(f"{src}/dir/file.txt")
         self._run_copy(f"{src}/dir", dst)
-        self.assertTrue(op.isfile(f"{src}/dir/file.txt"))
-        self.assertTrue(op.isfile(f"{dst}/dir/file.txt"))
+        self.assertTreeEqual(src, {"dir/file.txt": _CONTENT})
+        self.assertTreeEqual(dst, {"dir/file.txt": _CONTENT})
 
     def test_copy_dir2(self):
         src, dst = self.src, self.dst
@@ -88,9 +119,8 @@ class TestFileOperations(unittest.TestCase):
         self._touch(f"{src}/dir/file.txt", "src")
         self._touch(f"{dst}/dir/file.txt")
         self._run_copy(f"{src}/dir", dst)
-        self.assertTrue(op.isfile(f"{src}/dir/file.txt"))
-        self.assertFileContent(f"{dst}/dir/file.txt", "src")
-        self.assertFalse(op.exists(f"{dst}/dir/dir"))
+        self.assertTreeEqual(src, {"dir/file.txt": b"src"})
+        self.assertTreeEqual(dst, {"dir/file.txt": b"src"})
 
     def test_copy_dir3(self):
         src, dst = self.src, self.dst
@@ -101,18 +131,23 @@ class TestFileOperations(unittest.TestCase):
         self._touch(f"{dst}/dir/file3.txt")
 
         self._run_copy(f"{src}/dir", dst)
-        self.assertTrue(op.isfile(f"{src}/dir/file1.txt"))
-        self.assertFileContent(f"{dst}/dir/file1.txt", "src")
-        self.assertFileContent(f"{dst}/dir/file2.txt", "src")
-        self.assertTrue(op.isfile(f"{dst}/dir/file3.txt"))
+        self.assertTreeEqual(src, {"dir/file1.txt": b"src", "dir/file2.txt": b"src"})
+        self.assertTreeEqual(
+            dst,
+            {
+                "dir/file1.txt": b"src",
+                "dir/file2.txt": b"src",
+                "dir/file3.txt": _CONTENT,
+            },
+        )
 
     def test_copy_file1(self):
         src, dst = self.src, self.dst
         # copy file
         self._touch(f"{src}/file.txt")
         self._run_copy(f"{src}/file.txt", dst)
-        self.assertTrue(op.isfile(f"{src}/file.txt"))
-        self.assertTrue(op.isfile(f"{dst}/file/file.txt"))
+        self.assertTreeEqual(src, {"file.txt": _CONTENT})
+        self.assertTreeEqual(dst, {"file/file.txt": _CONTENT})
 
     def test_copy_file2(self):
         src, dst = self.src, self.dst
@@ -120,20 +155,51 @@ class TestFileOperations(unittest.TestCase):
         self._touch(f"{src}/file.txt", "src")
         self._touch(f"{dst}/file/file.txt")
         self._run_copy(f"{src}/file.txt", dst)
-        self.assertTrue(op.isfile(f"{src}/file.txt"))
-        self.assertFileContent(f"{dst}/file/file.txt", "src")
+        self.assertTreeEqual(src, {"file.txt": b"src"})
+        self.assertTreeEqual(dst, {"file/file.txt": b"src"})
 
 
-class TestKnapsack(unittest.TestCase):
+class KnapsackRandomMixin:
+    """Random instance tests, shared by the fast and the scaling test cases.
+    Subclasses provide `_get_random`."""
 
     max_cells = 1024**2
+    n_instances = 10
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        # Seeded, so failures are reproducible
+        rng = random.Random(0)
+        cls._instances = [cls._get_random(rng) for _ in range(cls.n_instances)]
+
+    def test_full(self):
+        # capacity >= sum(weights)
+        for i, (w, v, _) in enumerate(self._instances):
+            c = sum(w) + i
+            with self.subTest(n=len(w), cap=c):
+                answer = set(range(len(w)))
+                result = knapsack(w, v, c, max_cells=self.max_cells)
+                self.assertSetEqual(result, answer)
+
+    def test_sum(self):
+        # sum of result's weights should <= capacity
+        for w, v, c in self._instances:
+            with self.subTest(n=len(w), cap=c):
+                result = knapsack(w, v, c, max_cells=self.max_cells)
+                self.assertLessEqual(sum(w[i] for i in result), c)
+
+
+class TestKnapsackFast(KnapsackRandomMixin, unittest.TestCase):
 
     @staticmethod
-    def _get_random():
-        n = random.randint(5, 100)
-        weights = random.choices(range(500 * 1024**2, 10 * 1024**4), k=n)
-        values = random.choices(range(1, 5000), k=n)
-        capacity = sum(weights) // random.randint(2, 5)
+    def _get_random(rng: random.Random):
+        # Small enough that (capacity + 1) * (n + 1) stays within max_cells, so
+        # the DP table is not scaled
+        n = rng.randint(5, 50)
+        weights = rng.choices(range(1, 200), k=n)
+        values = rng.choices(range(1, 5000), k=n)
+        capacity = sum(weights) // rng.randint(2, 5)
         return weights, values, capacity
 
     @staticmethod
@@ -154,22 +220,7 @@ class TestKnapsack(unittest.TestCase):
         ]
         answer = set()
         for w, v, c in data:
-            self.assertSetEqual(knapsack(w, v, c, self.max_cells), answer)
-
-    def test_full(self):
-        # capacity >= sum(weights)
-        for i in range(3):
-            w, v, _ = self._get_random()
-            c = sum(w) + i
-            answer = set(range(len(w)))
-            self.assertSetEqual(knapsack(w, v, c, self.max_cells), answer)
-
-    def test_sum(self):
-        # sum of result's weights should <= capacity
-        for _ in range(3):
-            w, v, c = self._get_random()
-            result = knapsack(w, v, c, self.max_cells)
-            self.assertLessEqual(sum(w[i] for i in result), c)
+            self.assertSetEqual(knapsack(w, v, c, max_cells=self.max_cells), answer)
 
     def test_simple(self):
         # a simple problem
@@ -177,22 +228,88 @@ class TestKnapsack(unittest.TestCase):
         v = [22, 12, 16, 10, 35, 26, 42, 53]
         c = 100
         answer = {0, 1, 3, 4, 5}
-        self.assertSetEqual(knapsack(w, v, c, self.max_cells), answer)
+        self.assertSetEqual(knapsack(w, v, c, max_cells=self.max_cells), answer)
+
+    def test_special_weight(self):
+        # zero weights are always included, oversize weights never fit
+        data = [
+            ([0, 2], [1, 1], 1, {0}),
+            ([5, 1, 2], [10, 1, 1], 3, {1, 2}),
+            ([0, 4, 3, 9], [1, 5, 4, 100], 7, {0, 1, 2}),
+        ]
+        for w, v, c, answer in data:
+            self.assertSetEqual(knapsack(w, v, c, max_cells=self.max_cells), answer)
 
     @unittest.skipIf(knapsack_solver is None, "OR-Tools not available")
     def test_comparative(self):
-        # compare with OR-Tools
-        for _ in range(50):
-            n = random.randint(10, 50)
-            weights = random.choices(range(1, 500), k=n)
-            values = random.choices(range(1, 500), k=n)
-            capacity = sum(weights) // random.randint(2, 4)
-
-            result = knapsack(weights, values, capacity)
-            answer = self._ortools_solve(weights, values, capacity)
-
-            self.assertLessEqual(sum(weights[i] for i in result), capacity)
-            self.assertEqual(sum(values[i] for i in result), answer)
+        # compare with OR-Tools, on the same instances as test_sum
+        for w, v, c in self._instances:
+            with self.subTest(n=len(w), cap=c):
+                result = knapsack(w, v, c)
+                answer = self._ortools_solve(w, v, c)
+                self.assertLessEqual(sum(w[i] for i in result), c)
+                self.assertEqual(sum(v[i] for i in result), answer)
+
+
+class TestKnapsackScaling(KnapsackRandomMixin, unittest.TestCase):
+
+    # This is the path production takes (byte-sized weights with max_cells),
+    # so a few instances always run; set SLOW_TESTS for the full sweep.
+    n_instances = 10 if os.environ.get("SLOW_TESTS") else 3
+
+    @staticmethod
+    def _get_random(rng: random.Random):
+        # Large weights force the solver to scale down the DP table
+        n = rng.randint(5, 100)
+        weights = rng.choices(range(500 * 1024**2, 10 * 1024**4), k=n)
+        values = rng.choices(range(1, 5000), k=n)
+        capacity = sum(weights) // rng.randint(2, 5)
+        return weights, values, capacity
+
+
+@unittest.skipIf(trie_to_regex is None, "Regen not available")
+class TestTrieToRegex(unittest.TestCase):
+
+    def assertRegexSetEqual(self, words, others):
+        """Assert that the regex of `words` fullmatches each of `words` and
+        none of `others`."""
+        match = re.compile(trie_to_regex(words)).fullmatch
+        for w in words:
+            self.assertTrue(match(w), w)
+        for w in others:
+            self.assertFalse(match(w), w)
+
+    def test_simple(self):
+        self.assertEqual(trie_to_regex(["abc", "abd", "x"]), "ab(c|d)|x")
+        self.assertRegexSetEqual(["abc", "abd", "x"], ["ab", "abcd", "xx", ""])
+
+    def test_prefix(self):
+        # words that are prefixes of others
+        self.assertEqual(trie_to_regex(["ab", "abc", "abd", "x"]), "ab(c|d)?|x")
+        self.assertRegexSetEqual(
+            ["ab", "abc", "abd", "x"], ["a", "abcd", "abx", "xab", ""]
+        )
+        self.assertRegexSetEqual(["a", "ab", "abc"], ["b", "ac", "abcd", ""])
+
+    def test_chain(self):
+        # single-child chains
+        self.assertEqual(trie_to_regex(["abcdef"]), "abcdef")
+        self.assertRegexSetEqual(["abcdef"], ["abcde", "abcdefg", ""])
+        self.assertRegexSetEqual(["abcdef", "abcxyz"], ["abc", "abcdez", "abcxyf"])
+
+    def test_hyphen(self):
+        words = ["-a", "a-", "a-b", "a-b-c", "ab"]
+        self.assertRegexSetEqual(words, ["a", "-", "a-b-", "ab-", "-a-"])
+
+    def test_random(self):
+        rng = random.Random(0)
+        words = {
+            "".join(rng.choices("ab-", k=rng.randint(1, 6))) for _ in range(200)
+        }
+        others = {
+            "".join(rng.choices("ab-", k=rng.randint(0, 7))) for _ in range(500)
+        }
+        self.assertRegexSetEqual(sorted(words), others - words)
 
 
 if __name__ == "__main__":
@@ -21,20 +21,44 @@ Data Files:
 - keywords-include.txt: Keywords to include in the regex.
 - keywords-exclude.txt: Keywords to exclude from the regex.
 
+Environment:
+------------
+- QM_VERIFY_REGEX: Regen output is verified against its input unless it is
+  50,000 characters or longer. Set to "1" to always verify, or "0" to never.
+
 Author:
 -------
 - David Pi
 """
 
 import argparse
+import hashlib
+import heapq
 import json
+import os
 import re
 import shutil
+import tempfile
+from functools import lru_cache
+from importlib.metadata import PackageNotFoundError, version
 from itertools import chain, filterfalse, islice
 from pathlib import Path
+from typing import Callable
 
+import regen
 from regen import Regen
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    REGEN_VERSION = version("regen")
+except PackageNotFoundError:
+    REGEN_VERSION = getattr(regen, "__version__", None)
+REGEN_CACHE_FORMAT = "1"
+
 script_dir = Path(__file__).resolve().parent
 entry_dir = script_dir.parent
 
@@ -57,6 +81,12 @@ SOFTWARE_REGEX = r"\b(adobe|microsoft|windows|x(64|86)|(32|64)bit|v[0-9]+(\.[0-9
 TV_REGEX = r"\b(s(0[1-9]|[1-3][0-9])|e(0[1-9]|[1-9][0-9])|ep(0[1-9]|[1-9][0-9]|1[0-9]{2})|s(0?[1-9]|[1-3][0-9])[ .-]?e(0?[1-9]|[1-9][0-9]|1[0-9]{2}))\b"
 AV_TEMPLATE = r"\b({keywords}|[0-9]{{,5}}({prefixes})-?[0-9]{{2,8}}([a-z]|f?hd)?)\b"
 # fmt: on
+SOFTWARE_RE = re.compile(SOFTWARE_REGEX, re.ASCII)
+TV_RE = re.compile(TV_REGEX, re.ASCII)
+VIDEO_EXTS_SORTED = tuple(sorted(VIDEO_EXTS))
+AUDIO_EXTS_SORTED = tuple(sorted(AUDIO_EXTS))
+# Plain words, which match themselves literally as regex
+is_literal = re.compile(r"[0-9a-z-]+").fullmatch
 
 
 def parse_args():
@@ -78,6 +108,7 @@ def parse_args():
     return parser.parse_args()
 
 
+@lru_cache(maxsize=None)
 def get_common_words():
     # https://github.com/first20hours/google-10000-english
     # https://www.cs.cmu.edu/Groups/AI/areas/nlp/corpora/names/
@@ -87,29 +118,35 @@ def get_common_words():
         "common-male-names.txt",
     )
     result = set()
+    update = result.update
     for file in files:
-        with open(script_dir.joinpath(file), "r", encoding="utf-8") as f:
-            result.update(map(str.lower, filter(str.isalpha, map(str.strip, f))))
-    return result
+        lines = script_dir.joinpath(file).read_text(encoding="utf-8").splitlines()
+        update(w for l in lines if (w := l.strip().lower()).isalpha() and w.isascii())
+    return frozenset(result)
 
 
 def read_pattern_file(filename: str):
     path = script_dir.joinpath(filename)
     try:
-        with open(path, "r+", encoding="utf-8") as f:
-            old_data = f.read().splitlines()
-            new_data = map(str.lower, filter(None, map(str.strip, old_data)))
-            new_data = sorted(frozenset(new_data))
-            if new_data != old_data:
-                f.seek(0)
-                f.writelines(l + "\n" for l in new_data)
-                f.truncate()
-                print(f"Updated: {filename}")
+        mtime = path.stat().st_mtime_ns
     except FileNotFoundError:
         open(path, "w").close()
         return ()
-    else:
-        return new_data
+    return _read_pattern_file(path, mtime)
+
+
+@lru_cache(maxsize=32)
+def _read_pattern_file(path: Path, mtime_ns: int):
+    # Results are cached by (path, mtime), so unchanged files are read once.
+    old_data = path.read_text(encoding="utf-8").splitlines()
+    # Same normalization as the regex requirements: lowercase, "_" -> "-"
+    new_data = {s.lower().replace("_", "-") for l in old_data if (s := l.strip())}
+    new_data = sorted(new_data)
+    if new_data != old_data:
+        text = "\n".join(new_data) + "\n" if new_data else ""
+        path.write_text(text, encoding="utf-8")
+        print(f"Updated: {path.name}")
+    return tuple(new_data)
 
 
 def build_regex(
@@ -117,28 +154,58 @@ def build_regex(
     source: dict,
     max_items: int,
     ex_set: set = None,
-    ex_lst: tuple = (),
+    ex_fullmatch: Callable = None,
 ):
     # ex_set: a set of strings to be excluded (literal match)
-    # ex_lst: a list of regex to filter the source (regex match)
+    # ex_fullmatch: a compiled fullmatch method to filter the source (regex match)
 
     assert name in ("keywords", "prefixes")
 
-    # Data from footprints, sorted by frequency
+    # Data from footprints, as (-frequency, name) pairs
     source: dict = source[name]
-    data: list = sorted(
-        (source.keys() - ex_set) if ex_set else source,
-        key=source.get,
-        reverse=True,
-    )
+    total = sum(source.values())
+    if ex_set:
+        items = [(-v, k) for k, v in source.items() if k not in ex_set]
+    else:
+        items = [(-v, k) for k, v in source.items()]
 
     # Inclusion and exclusion pattern files
     include = read_pattern_file(f"{name}-include.txt")
     exclude = read_pattern_file(f"{name}-exclude.txt")
 
-    # Remove anything that overlaps the pattern files or 'ex_lst'
-    regex = re.compile("|".join(chain(include, exclude, ex_lst)))
-    data[:] = islice(filterfalse(regex.fullmatch, data), max_items)
+    # Remove anything that overlaps the pattern files or 'ex_fullmatch'. Plain
+    # words are tested by set lookup, only the rest are joined into a regex.
+    literals = set()
+    patterns = []
+    for s in chain(include, exclude):
+        if is_literal(s):
+            literals.add(s)
+        else:
+            patterns.append(s)
+    fullmatch = re.compile("|".join(patterns)).fullmatch if patterns else None
+
+    def select(items):
+        """Take up to `max_items` names from sorted `items` that pass the
+        filters."""
+        it = (k for _, k in items)
+        if literals:
+            it = (d for d in it if d not in literals)
+        if fullmatch:
+            it = filterfalse(fullmatch, it)
+        if ex_fullmatch:
+            it = filterfalse(ex_fullmatch, it)
+        return list(islice(it, max_items))
+
+    # Sort by frequency (descending), then by name. Only the top of the list
+    # is needed, so try a bounded heap first and fall back to a full sort if
+    # the filters leave too few.
+    data = None
+    n = 4 * max_items
+    if n < len(items):
+        data = select(heapq.nsmallest(n, items))
+    if data is None or len(data) < max_items:
+        items.sort()
+        data = select(items)
 
     print(
         "Selected {:,} of {:,} {} from source. Frequency: [{}, {}], coverage: {:.1%} ".format(
@@ -147,7 +214,7 @@ def build_regex(
             name,
             source[data[-1]],
             source[data[0]],
-            sum(map(source.get, data)) / sum(source.values()),
+            sum(map(source.__getitem__, data)) / total,
         )
     )
 
@@ -156,9 +223,16 @@ def build_regex(
     data.sort()
     print(f"{len(data):,} {name} are included to build the regex.")
 
-    # Generate and verify the regex
-    regen = Regen(data)
-    regex = regen.to_regex(omitOuterParen=True)
+    # Generate and verify the regex. Plain words only need their common
+    # prefixes merged, which is a linear trie walk; Regen is reserved for
+    # inputs that contain regex syntax.
+    if all(map(is_literal, data)):
+        regex = trie_to_regex(data)
+        match = re.compile(regex).fullmatch
+        if not all(map(match, data)):
+            raise ValueError(f"Trie regex for {name} does not match its input.")
+    else:
+        regex = regen_to_regex(tuple(data))
 
     concat = "|".join(data)
     diff = len(regex) - len(concat)
@@ -168,7 +242,6 @@ def build_regex(
         )
         regex = concat
     else:
-        regen._verify()
         print(f"Final regex length for {name}: {len(regex)} ({diff})")
 
     if not regex:
@@ -176,28 +249,112 @@ def build_regex(
     return regex
 
 
+@lru_cache(maxsize=8)
+def regen_to_regex(words: tuple) -> str:
+    """Compute and verify the Regen regex of `words`. Verified results are also
+    cached on disk, keyed by the Regen version and the input, so unchanged
+    inputs skip Regen. Results that were not verified (see QM_VERIFY_REGEX) are
+    not cached; set QM_VERIFY_REGEX=1 to cache regexes of 50,000 characters or
+    longer."""
+    cache = None
+    if REGEN_VERSION is not None:
+        key = "\n".join((REGEN_CACHE_FORMAT, REGEN_VERSION, *words))
+        digest = hashlib.blake2b(key.encode(), digest_size=16).hexdigest()
+        cache = script_dir.joinpath(".regen_cache", f"{digest}.re")
+        try:
+            regex = cache.read_text(encoding="utf-8")
+        except (OSError, UnicodeDecodeError):
+            pass  # Unreadable entries are treated as a miss
+        else:
+            if regex:  # Empty entries are ignored and rewritten
+                return regex
+
+    gen = Regen(list(words))
+    regex = gen.to_regex(omitOuterParen=True)
+    if len(regex) <= len("|".join(words)):
+        # Only verify if the result can beat simple concatenation. Unverified
+        # results are not cached.
+        verify = os.environ.get("QM_VERIFY_REGEX")
+        if verify == "0" or (verify is None and len(regex) >= 50000):
+            return regex
+        gen._verify()
+
+    if cache is not None and regex:
+        # Write to a temporary file and rename it, so an interrupted run never
+        # leaves a partial entry behind. The cache is best-effort: a failed
+        # write is cleaned up and otherwise ignored.
+        tmp = None
+        try:
+            cache.parent.mkdir(exist_ok=True)
+            with tempfile.NamedTemporaryFile(
+                "w", encoding="utf-8", dir=cache.parent, suffix=".tmp", delete=False
+            ) as f:
+                tmp = f.name
+                f.write(regex)
+            os.replace(tmp, cache)
+            tmp = None
+        except OSError as e:
+            print(f"Warning: Unable to write Regen cache: {e}")
+        finally:
+            if tmp is not None:
+                try:
+                    os.unlink(tmp)
+                except OSError:
+                    pass
+    return regex
+
+
+def trie_to_regex(words) -> str:
+    """Build an alternation of literal `words` with the common prefixes merged,
+    e.g. ["abc", "abd", "x"] -> "ab(c|d)|x". The outer parenthesis is omitted.
+    """
+    trie = {}
+    for word in words:
+        node = trie
+        for c in word:
+            node = node.setdefault(c, {})
+        node[""] = None  # end of word
+
+    def emit(node: dict) -> str:
+        alts = [c + emit(child) for c, child in sorted(node.items()) if c]
+        if "" not in node:
+            if len(alts) == 1:
+                return alts[0]
+            return "({})".format("|".join(alts))
+        if not alts:
+            return ""
+        if len(alts) == 1 and len(alts[0]) == 1:
+            return alts[0] + "?"
+        return "({})?".format("|".join(alts))
+
+    return "|".join(c + emit(child) for c, child in sorted(trie.items()) if c)
+
+
 def validation(av_regex: str):
 
-    for regex in (SOFTWARE_REGEX, TV_REGEX, av_regex):
+    # The constant patterns are compiled at import, only av_regex is new.
+    re.compile(av_regex, re.ASCII)
+
+    for regex in (SOFTWARE_RE.pattern, TV_RE.pattern, av_regex):
         if not regex:
             raise ValueError("Empty regex.")
         if "_" in regex:
             raise ValueError(f'"_" character found in regex: {regex}')
-        if regex.lower() != regex:
+        if any(map(str.isupper, regex)):
             raise ValueError(f"Upper case character found in regex: {regex}")
-        re.compile(regex)
 
+    seen = set()
     for ext_set in (VIDEO_EXTS, AUDIO_EXTS):
         if not ext_set:
             raise ValueError("Empty extension set.")
         if not all(s.lower() == s and s.isalnum() for s in ext_set):
             raise ValueError("Invalid entry found in extension set.")
-
-    intersect = VIDEO_EXTS.intersection(AUDIO_EXTS)
-    if intersect:
-        raise ValueError(
-            f"Intersection found between extension sets: {', '.join(intersect)}"
-        )
+        intersect = seen.intersection(ext_set)
+        if intersect:
+            raise ValueError(
+                f"Intersection found between extension sets: {', '.join(intersect)}"
+            )
+        seen |= ext_set
 
 
 def main():
@@ -214,8 +371,7 @@ def main():
     except FileNotFoundError:
         print("Warning: Unable to update data file from footprints.")
 
-    with open(src, "r", encoding="utf-8") as f:
-        data = json.load(f)
+    data = json.loads(src.read_bytes())
 
     # Build regex for keywords
     keywords = build_regex(
@@ -229,7 +385,7 @@ def main():
         name="prefixes",
         source=data,
         max_items=args.max_prefixes,
-        ex_lst=(keywords,),
+        ex_fullmatch=re.compile(keywords).fullmatch,
     )
     # Construct
     av_regex = AV_TEMPLATE.format(keywords=keywords, prefixes=prefixes)
@@ -239,14 +395,16 @@ def main():
 
     # Save to JSON
     result = {
-        "video_exts": sorted(VIDEO_EXTS),
-        "audio_exts": sorted(AUDIO_EXTS),
+        "video_exts": VIDEO_EXTS_SORTED,
+        "audio_exts": AUDIO_EXTS_SORTED,
         "software_regex": SOFTWARE_REGEX,
         "tv_regex": TV_REGEX,
         "av_regex": av_regex,
     }
-    with open(dst, "w", encoding="utf-8") as f:
-        json.dump(result, f, separators=(",", ":"))
+    if orjson is not None:
+        dst.write_bytes(orjson.dumps(result))
+    else:
+        dst.write_text(json.dumps(result, separators=(",", ":")), encoding="utf-8")
 
 
 if __name__ == "__main__":